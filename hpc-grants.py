@@ -27,24 +27,29 @@ Options:
 
 import os
 import sys
+import time
+import tempfile
+import hashlib
+import threading
 import itertools
-from collections import OrderedDict
 import textwrap
 
 env_lib_dir = 'HPC_BURSAR_LIBDIR'
-if env_lib_dir in os.environ.keys():
+if env_lib_dir in os.environ:
     sys.path.append(os.environ[env_lib_dir])
 
-from datetime import datetime, timedelta
-from itertools import filterfalse
+from datetime import date, timedelta
+from operator import itemgetter
 from docopt import docopt
 import requests
+from requests.adapters import HTTPAdapter
 import pymunge
 import json
 
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 VERSION = '0.1'
 BURSAR_URL = os.getenv('HPC_BURSAR_URL', 'http://127.0.0.1:8000/api/v1/')
@@ -52,176 +57,281 @@ BURSAR_CERT_PATH = os.getenv('HPC_BURSAR_CERT_PATH', '')
 USER = os.getenv('USER', os.getlogin())
 SERVICE = 'user/grants_info'
 URL = BURSAR_URL + SERVICE
+USER_URL = URL + '/' + USER
+TIMEOUT = (3.05, 27)
+TOKEN_TTL = 60
+OLD_THRESHOLD = date.today() - timedelta(days=31)
+NO_DATA_ARGS = {'-h', '--help', '-v', '--version'}
+CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'hpcbursar')
+# the endpoint is part of the name, so clusters sharing a home directory do not read each other's grants
+CACHE_PATH = os.path.join(CACHE_DIR, f"grants_{USER}_{hashlib.sha256(USER_URL.encode()).hexdigest()[:12]}.json")
+CACHE_TTL = 60
+USE_CACHE = not os.getenv('HPC_BURSAR_NO_CACHE')
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+session.verify = BURSAR_CERT_PATH or True
+session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+
+token_cache = {}
 
 
 def generate_token(user, service):
+    now = time.monotonic()
+    token, expires = token_cache.get((user, service), (None, 0))
+    if token and now < expires:
+        return token
     user_service = user + ':' + service
     bytes_user_service = str.encode(user_service)
     with pymunge.MungeContext() as ctx:
         token = ctx.encode(bytes_user_service)
+    token_cache[(user, service)] = (token, now + TOKEN_TTL)
     return token
 
 
+def read_cache():
+    try:
+        if os.stat(CACHE_PATH).st_mtime <= time.time() - CACHE_TTL:
+            return None
+        with open(CACHE_PATH, 'rb') as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(data):
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, CACHE_PATH)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+
+
+class BursarError(Exception):
+    pass
+
+
 def get_data():
-    user = USER
+    if USE_CACHE:
+        data = read_cache()
+        if data is not None:
+            return data
+    data = fetch_data()
+    if USE_CACHE:
+        write_cache(data)
+    return data
+
+
+def fetch_data():
     header = {
-        'x-auth-hpcbursar': generate_token(user, SERVICE)
+        'x-auth-hpcbursar': generate_token(USER, SERVICE)
     }
     try:
-        response = requests.get(URL + '/' + user, headers=header, verify=False)
-        # response = requests.get(URL + '/' + user, headers=header, verify=BURSAR_CERT_PATH)
+        response = session.get(USER_URL, headers=header, timeout=TIMEOUT)
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
         return data
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 403:
-            print('You are unauthorized to perform this request!')
-            sys.exit(1)
+            raise BursarError('You are unauthorized to perform this request!')
         elif e.response.status_code != 200:
-            print("Invalid response from server!")
-            sys.exit(1)
+            raise BursarError("Invalid response from server!")
     except requests.exceptions.ConnectionError as e:
-        print("No connection")
-        sys.exit(1)
+        raise BursarError("No connection")
+    except requests.exceptions.Timeout:
+        raise BursarError("Connection timed out")
     except Exception as e:
         raise Exception('Unable to parse server\'s response!')
 
 
 
 
-def order_allocations(allocs):
-    return sorted(allocs, key=lambda x: x['resource'])
+def order_allocations(grant):
+    allocations = grant.get('_sorted_allocations')
+    if allocations is None:
+        allocations = sorted(grant['allocations'], key=itemgetter('resource'))
+        grant['_sorted_allocations'] = allocations
+    return allocations
 
 
 def format_number(value, name):
     if name == 'used hours':
-        return f'{value:,.2f}'.replace(',', ' ')
+        return format(value, '_.2f').replace('_', ' ')
     else:
-        return f'{value:,}'.replace(',', ' ')
+        return format(value, '_').replace('_', ' ')
+
+
+TYPE_SUFFIX = {
+    'timelimit': 'h',
+    'hours': 'h',
+    'capacity': 'GB',
+    'used hours': 'h'
+}
+
+PARAMETERS_ORDER = ('hours', 'timelimit', 'capacity')
 
 
 def process_parameter_value(name, value):
-    type_suffix = {
-        'timelimit': 'h',
-        'hours': 'h',
-        'capacity': 'GB',
-        'used hours': 'h'
-    }
-    return f'{format_number(value, name)} {type_suffix[name]}'
+    return f'{format_number(value, name)} {TYPE_SUFFIX[name]}'
 
 
 def process_parameters(params):
-    params = params.copy()
-    order = ['hours', 'timelimit', 'capacity']
-    ordered_params = OrderedDict()
-    for type in order:
-        if type in params.keys():
-            ordered_params[type] = process_parameter_value(type, params[type])
-            del params[type]
-    if params:
-        ordered_params.update(params)
+    ordered_params = {type: process_parameter_value(type, params[type])
+                      for type in PARAMETERS_ORDER if type in params}
+    for key, value in params.items():
+        if key not in ordered_params:
+            ordered_params[key] = value
     return ordered_params
 
 
 wrapper = textwrap.TextWrapper(initial_indent='    ', subsequent_indent='    ', width=57)
 
 
+def order_members(grant):
+    members = grant.get('_sorted_members')
+    if members is None:
+        members = sorted(grant['group_members'])
+        grant['_sorted_members'] = members
+    return members
+
+
+def format_members(data):
+    return f"   members:\n{wrapper.fill(', '.join(order_members(data)))}"
+
+
 def print_grant_short_info(data):
-    print(f"Grant: {data['name']}")
-    print(f"  status: {data['status']}, start: {data['start']}, end: {data['end']}")
-    print(f"  Group: {data['group']}")
-    print(f"   members:\n{wrapper.fill(', '.join(sorted(data['group_members'])))}")
+    sys.stdout.write('\n'.join((
+        f"Grant: {data['name']}",
+        f"  status: {data['status']}, start: {data['start']}, end: {data['end']}",
+        f"  Group: {data['group']}",
+        format_members(data),
+        '',
+    )))
 
 
 def print_grant_info(data):
-    print(f"Grant: {data['name']}")
-    print(f"  status: {data['status']}, start: {data['start']}, end: {data['end']}")
-    allocation_usages_dict = {}
-    for allocation_usage in data['allocations_usages']:
-        allocation_usages_dict[allocation_usage['name']] = allocation_usage
+    lines = [
+        f"Grant: {data['name']}",
+        f"  status: {data['status']}, start: {data['start']}, end: {data['end']}",
+    ]
+    allocation_usages_dict = {usage['name']: usage for usage in data['allocations_usages']}
 
-    allocations = order_allocations(data['allocations'])
+    allocations = order_allocations(data)
     if allocations:
         for al in allocations:
-            print(f"  Allocation: {al['name']}, resource: {al['resource']}")
-            print(f"   status: {al['status']}, start: {al['start']}, end: {al['end']},")
+            lines.append(f"  Allocation: {al['name']}, resource: {al['resource']}")
+            lines.append(f"   status: {al['status']}, start: {al['start']}, end: {al['end']},")
             parameters = process_parameters(al['parameters'])
-            print('   parameters: ' + ", ".join([f'{key}: {value}' for key, value in parameters.items()]))
+            lines.append('   parameters: ' + ", ".join(f'{key}: {value}' for key, value in parameters.items()))
 
-            if al['name'] in allocation_usages_dict.keys():
+            if al['name'] in allocation_usages_dict:
                 allocation_usage = allocation_usages_dict[al['name']]
                 consumed_resources = allocation_usage['summary']['resources']
-                print('   consumed resources: ' + ", ".join(
-                    [f"{k}: {process_parameter_value('used hours', v)}" for k, v in consumed_resources.items()]))
+                lines.append('   consumed resources: ' + ", ".join(
+                    f"{k}: {process_parameter_value('used hours', v)}" for k, v in consumed_resources.items()))
     else:
-        print('  - No allocations')
-    print(f"  Group: {data['group']}")
-    print(f"   members:\n{wrapper.fill(', '.join(sorted(data['group_members'])))}")
+        lines.append('  - No allocations')
+    lines.append(f"  Group: {data['group']}")
+    lines.append(format_members(data))
+    lines.append('')
+    sys.stdout.write('\n'.join(lines))
 
 
 def print_separator():
-    print('-' * 57)
+    sys.stdout.write('-' * 57 + '\n')
 
 
 # Filter functions
 
 def last(grant):
-    end_date_str = grant['end']
-    end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
-    present = datetime.now()
-    threshold = present - timedelta(days=31)
-    if (end_date > threshold):
-        return True
-    else:
-        return False
+    return date.fromisoformat(grant['end']) > OLD_THRESHOLD
 
 
 def active(grant):
-    if grant['status'] == "active":
-        return True
-    else:
-        return False
+    return grant['status'] == 'active'
+
+
+def inactive(grant):
+    return grant['status'] != 'active'
 
 
 def has_allocations(data):
-    if data['allocations']:
-        return True
-    else:
-        return False
+    return bool(data.get('allocations'))
+
+
+def prefetch_data(result):
+    # runs in the background thread, errors are reported by load_data in the main thread
+    try:
+        result['data'] = get_data()
+    except BaseException as e:
+        result['error'] = e
+
+
+def load_data(prefetch, result):
+    if prefetch is None:
+        return get_data()
+    prefetch.join()
+    if 'error' in result:
+        raise result['error']
+    return result['data']
 
 
 def main():
+    # start fetching grants while the command line is being parsed, the thread is a daemon
+    # so exiting on a usage error or --version does not wait for the network
+    prefetch = None
+    result = {}
+    if not NO_DATA_ARGS.intersection(sys.argv[1:]):
+        prefetch = threading.Thread(target=prefetch_data, args=(result,), daemon=True)
+        prefetch.start()
+
     args = docopt(__doc__)
 
     if args['--version']:
         print(f'hpc-grants version: {VERSION}')
         sys.exit(0)
 
-    data = sorted(get_data(), key=lambda x: x['start'], reverse=True)
-
-    filtered_grants = data
+    filters = []
 
     # positive filters
     if args['--active']:
-        filtered_grants = list(filter(active, filtered_grants))
+        filters.append(active)
 
     if args['--inactive']:
-        filtered_grants = list(filterfalse(active, filtered_grants))
+        filters.append(inactive)
 
     # negative filters
     if not args['--empty']:
-        filtered_grants = list(filter(has_allocations, filtered_grants))
+        filters.append(has_allocations)
 
     if not args['--old']:
-        filtered_grants = list(filter(last, filtered_grants))
+        filters.append(last)
+
+    try:
+        data = load_data(prefetch, result)
+    except BursarError as e:
+        print(e)
+        sys.exit(1)
+    filtered_grants = sorted((grant for grant in data if all(f(grant) for f in filters)),
+                             key=itemgetter('start'), reverse=True)
 
     printer = print_grant_info
     if args['--short']:
         printer = print_grant_short_info
 
-    for j in filtered_grants:
+    last_idx = len(filtered_grants) - 1
+    for i, j in enumerate(filtered_grants):
         printer(j)
-        if j != filtered_grants[-1]:
+        if i < last_idx:
             print_separator()
 
 
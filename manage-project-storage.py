@@ -6,41 +6,64 @@
 # copy of the license is available in the LICENSE file;
 
 """
-hpc-grants - Show available grant with details.
+manage-project-storage - Create project directories and synchronize their quotas with granted storage.
 
 Usage:
-    hpc-grants
-    hpc-grants -h | --help
-    hpc-grants -v | --verbose
-    hpc-grants -V | --version
+    manage-project-storage [-v | --verbose] [--project-base=<path>] [--project-fs=<path>] [--resource=<name>]
+    manage-project-storage -h | --help
+    manage-project-storage -V | --version
 
 Options:
     -h --help   Show help.
     -v --verbose   Show additional info.
     -V --version   Show version.
+    --project-base=<path>   Directory holding project directories [default: /net/pr2/projects/plgrid/].
+    --project-fs=<path>     Lustre file system the project quotas are set on [default: /net/pr2/].
+    --resource=<name>       Allocation resource holding storage capacity [default: storage].
 """
 
 import os
 import stat
 import sys
+import time
 import subprocess
+import threading
 import grp
+import ctypes
+import ctypes.util
+import fcntl
+import struct
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 env_lib_dir = 'HPC_BURSAR_LIBDIR'
-if env_lib_dir in os.environ.keys():
+if env_lib_dir in os.environ:
     sys.path.append(os.environ[env_lib_dir])
 
 from docopt import docopt
 import pymunge
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 import json
 import datetime
 
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
 PROJECT_BASE = '/net/pr2/projects/plgrid/'
 PROJECT_FS = '/net/pr2/'
 LFS_PATH = '/usr/bin/lfs'
+STORAGE_RESOURCE = 'storage'
+ACTIVE_STATES = frozenset({'accepted', 'active'})
 
-MODE = 2770
+MODE = stat.S_ISGID | stat.S_IRWXU | stat.S_IRWXG
+WORKERS = 16
+MAX_PENDING_COMMANDS = 32
 
 VERSION = '0.1'
 BURSAR_URL = os.getenv('HPC_BURSAR_URL', 'http://127.0.0.1:8000/api/v1/')
@@ -48,21 +71,41 @@ BURSAR_CERT_PATH = os.getenv('HPC_BURSAR_CERT_PATH', '')
 USER = os.getenv('USER', 'root')
 SERVICE = 'admin/grants_group_info'
 URL = BURSAR_URL + SERVICE
+TIMEOUT = (3, 10)
+# kept safely below munge's default credential lifetime of 300 seconds
+TOKEN_TTL = 210
+STREAMED_KEYS = ('groups', 'grants')
+STREAMED_PREFIXES = {f'{key}.item': key for key in STREAMED_KEYS}
+
+session = requests.Session()
+session.mount(BURSAR_URL, HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
 verbose = False
 
 
 def debug(text):
     if verbose:
-        print(text)
+        # single write, so lines from worker threads do not interleave
+        sys.stdout.write(f'{text}\n')
+
+
+munge_ctx = None
+token_cache = {}
 
 
 def generate_token(user, service):
+    global munge_ctx
+    now = time.monotonic()
+    token, expires = token_cache.get((user, service), (None, 0))
+    if token and now < expires:
+        return token
+    if munge_ctx is None:
+        munge_ctx = pymunge.MungeContext()
     user_service = user + ':' + service
     bytes_user_service = str.encode(user_service)
-    with pymunge.MungeContext() as ctx:
-        user_service = ctx.encode(bytes_user_service)
-    return user_service
+    token = munge_ctx.encode(bytes_user_service)
+    token_cache[(user, service)] = (token, now + TOKEN_TTL)
+    return token
 
 
 def get_data():
@@ -70,98 +113,331 @@ def get_data():
     header = {
         'x-auth-hpcbursar': generate_token(user, SERVICE)
     }
-    response = requests.get(URL + '/', headers=header, verify=BURSAR_CERT_PATH)
+    try:
+        response = session.get(URL + '/', headers=header, verify=BURSAR_CERT_PATH, timeout=TIMEOUT, stream=True)
+    except requests.exceptions.ConnectionError:
+        # a pooled keep-alive connection may have been dropped by the server, retry once on a fresh one
+        debug('Connection error, retrying request')
+        response = session.get(URL + '/', headers=header, verify=BURSAR_CERT_PATH, timeout=TIMEOUT, stream=True)
     if response.status_code == 403:
         raise Exception('You are unauthorized to perform this request!')
     elif response.status_code != 200:
         raise Exception('Invalid response from server!')
 
     try:
-        data = response.json()
-        return data
+        yield from iter_items(response)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+        # the body is read while it is parsed, transfer errors are not parse errors
+        raise Exception(f'Error while receiving server\'s response: {e}')
     except Exception as e:
         raise Exception('Unable to parse server\'s response!')
 
 
-def execute(cmd):
-    cmd_full = cmd
-    debug('Executing command: %s' % str(cmd_full))
-    cp = subprocess.run(cmd_full, capture_output=True)
-    # output is converted to utf8 string!
-    return cp.returncode, cp.stdout.decode(), cp.stderr.decode()
+def iter_items(response):
+    # yields ('groups', group) and ('grants', grant) pairs in the order they arrive,
+    # with ijson the response is parsed while it is downloaded instead of as one document
+    if ijson is None:
+        data = response.json()
+        for key in STREAMED_KEYS:
+            for item in data[key]:
+                yield key, item
+        return
+
+    response.raw.decode_content = True
+    builder = None
+    seen_keys = set()
+    for prefix, event, value in ijson.parse(response.raw, use_float=True):
+        if event == 'start_array' and prefix in STREAMED_KEYS:
+            seen_keys.add(prefix)
+        if builder is None:
+            if event != 'start_map' or prefix not in STREAMED_PREFIXES:
+                continue
+            builder = ObjectBuilder()
+            item_prefix = prefix
+        builder.event(event, value)
+        if event == 'end_map' and prefix == item_prefix:
+            yield STREAMED_PREFIXES[item_prefix], builder.value
+            builder = None
+    # fail like the response.json() path when the response does not have the expected shape
+    missing_keys = set(STREAMED_KEYS) - seen_keys
+    if missing_keys:
+        raise KeyError(', '.join(sorted(missing_keys)))
+
+
+def execute_capture(cmd):
+    debug('Executing command: %s' % str(cmd))
+    # output is decoded to utf8 string by subprocess itself
+    cp = subprocess.run(cmd, capture_output=True, encoding='utf-8')
+    return cp.returncode, cp.stdout, cp.stderr
+
+
+pending_commands = []
+failed_commands = []
+pending_lock = threading.Lock()
+
+
+def execute_async(cmd):
+    # for commands whose output is not needed, started without waiting so lfs calls overlap,
+    # finished and reported by wait_commands()
+    debug('Executing command: %s' % str(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+    oldest = None
+    with pending_lock:
+        pending_commands.append(process)
+        if len(pending_commands) > MAX_PENDING_COMMANDS:
+            oldest = pending_commands.pop(0)
+    if oldest is not None:
+        # usually another group's command, its failure is only recorded for wait_commands()
+        error = wait_command(oldest)
+        if error:
+            with pending_lock:
+                failed_commands.append(error)
+
+
+def wait_command(process):
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        return f"Command {' '.join(process.args)} failed: {stderr.strip()}"
+    return None
+
+
+def wait_commands():
+    while pending_commands:
+        error = wait_command(pending_commands.pop(0))
+        if error:
+            failed_commands.append(error)
+    for error in failed_commands:
+        print(error)
+    return not failed_commands
+
+
+# in-process access to Lustre quotas through liblustreapi, layouts follow lustre_user.h
+
+LUSTRE_Q_GETQUOTA = 0x800007
+LUSTRE_Q_SETQUOTA = 0x800008
+PRJQUOTA = 2
+QIF_BLIMITS = 1
+
+
+class ObdDqinfo(ctypes.Structure):
+    _fields_ = [('dqi_bgrace', ctypes.c_uint64),
+                ('dqi_igrace', ctypes.c_uint64),
+                ('dqi_flags', ctypes.c_uint32),
+                ('dqi_valid', ctypes.c_uint32)]
+
+
+class ObdDqblk(ctypes.Structure):
+    _fields_ = [('dqb_bhardlimit', ctypes.c_uint64),
+                ('dqb_bsoftlimit', ctypes.c_uint64),
+                ('dqb_curspace', ctypes.c_uint64),
+                ('dqb_ihardlimit', ctypes.c_uint64),
+                ('dqb_isoftlimit', ctypes.c_uint64),
+                ('dqb_curinodes', ctypes.c_uint64),
+                ('dqb_btime', ctypes.c_uint64),
+                ('dqb_itime', ctypes.c_uint64),
+                ('dqb_valid', ctypes.c_uint32),
+                ('dqb_padding', ctypes.c_uint32)]
+
+
+class IfQuotactl(ctypes.Structure):
+    _fields_ = [('qc_cmd', ctypes.c_uint32),
+                ('qc_type', ctypes.c_uint32),
+                ('qc_id', ctypes.c_uint32),
+                ('qc_stat', ctypes.c_uint32),
+                ('qc_valid', ctypes.c_uint32),
+                ('qc_idx', ctypes.c_uint32),
+                ('qc_dqinfo', ObdDqinfo),
+                ('qc_dqblk', ObdDqblk),
+                ('obd_type', ctypes.c_char * 16),
+                ('obd_uuid', ctypes.c_char * 40)]
+
+
+# generic project id ioctls from linux/fs.h, the same ones 'lfs project' uses
+FS_IOC_FSGETXATTR = 0x801C581F
+FS_IOC_FSSETXATTR = 0x401C5820
+FS_XFLAG_PROJINHERIT = 0x00000200
+FSXATTR_FORMAT = '=IIIII8s'
+
+
+def load_lustreapi():
+    name = ctypes.util.find_library('lustreapi')
+    if name is None:
+        return None
+    try:
+        lib = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    lib.llapi_quotactl.argtypes = [ctypes.c_char_p, ctypes.POINTER(IfQuotactl)]
+    lib.llapi_quotactl.restype = ctypes.c_int
+    return lib
+
+
+lustreapi = load_lustreapi()
+
+
+def quotactl(cmd, gid, dqblk=None):
+    qctl = IfQuotactl(qc_cmd=cmd, qc_type=PRJQUOTA, qc_id=gid)
+    if dqblk is not None:
+        qctl.qc_dqblk = dqblk
+    rc = lustreapi.llapi_quotactl(PROJECT_FS.encode(), ctypes.byref(qctl))
+    if rc != 0:
+        raise OSError(-rc, f'llapi_quotactl failed for project {gid}: {os.strerror(-rc)}')
+    return qctl.qc_dqblk
 
 
 def sum_storage(grants):
-    sum = 0
-    for grant in grants:
-        if 'allocations' in grant.keys():
-            for allocation in grant['allocations']:
-                if allocation['resource'] == 'storage':
-                    sum += allocation['parameters']['capacity']
-    return sum
+    return sum(allocation['parameters']['capacity']
+               for grant in grants
+               for allocation in grant.get('allocations', ())
+               if allocation['resource'] == STORAGE_RESOURCE)
+
+
+def quota_pattern(project_fs):
+    # hard limit column of the '<fs> <kbytes> <quota> <limit> ...' row,
+    # lfs wraps the row after the file system name when it is long
+    return re.compile(rf'^\s*{re.escape(project_fs)}\s+\S+\s+\S+\s+(\d+)', re.M)
+
+
+QUOTA_RE = quota_pattern(PROJECT_FS)
 
 
 def check_quota(gid):
+    if lustreapi is not None:
+        debug(f'Getting quota of project {gid} with liblustreapi')
+        return quotactl(LUSTRE_Q_GETQUOTA, gid).dqb_bhardlimit >> 20
     cmd = [LFS_PATH, 'quota', '-p', str(gid), PROJECT_FS]
-    return_code, stdout, stderr = execute(cmd)
+    return_code, stdout, stderr = execute_capture(cmd)
+    match = QUOTA_RE.search(stdout)
+    if match:
+        return int(match.group(1)) >> 20
+
+
+def get_all_quotas():
+    # one 'lfs quota -a' dump of every project id instead of a call per group,
+    # returns None when lfs does not support listing all ids
+    cmd = [LFS_PATH, 'quota', '-a', '-p', PROJECT_FS]
+    return_code, stdout, stderr = execute_capture(cmd)
+    if return_code != 0:
+        debug(f'Unable to list all project quotas: {stderr.strip()}')
+        return None
     stdout = stdout.replace(PROJECT_FS + '\n', PROJECT_FS)
+    quotas = {}
     for line in stdout.split('\n'):
-        if PROJECT_FS in line:
-            parts = line.split()
-            quota = int(int(parts[3]) / 1024 / 1024)
-            return quota
+        parts = line.split()
+        # rows look like '<fs> <id> <kbytes> <quota> <limit> ...', the fs column is optional
+        if parts and parts[0].rstrip('/') == PROJECT_FS.rstrip('/'):
+            parts = parts[1:]
+        if len(parts) < 4 or not parts[0].isdigit():
+            continue
+        quotas[int(parts[0])] = int(parts[3].rstrip('*')) >> 20
+    return quotas
 
 
 def set_quota(gid, quota):
-    quota_kb = quota * 1024 * 1024
+    quota_kb = int(quota * 1024 * 1024)
+    if lustreapi is not None:
+        debug(f'Setting quota of project {gid} to {quota_kb} KB with liblustreapi')
+        # keep the soft limit as it is, like 'lfs setquota -B' does
+        dqblk = quotactl(LUSTRE_Q_GETQUOTA, gid)
+        dqblk.dqb_bhardlimit = quota_kb
+        dqblk.dqb_valid = QIF_BLIMITS
+        quotactl(LUSTRE_Q_SETQUOTA, gid, dqblk)
+        return
     cmd = [LFS_PATH, 'setquota', '-p', str(gid), '-B', f'{quota_kb}', PROJECT_FS]
-    execute(cmd)
+    execute_async(cmd)
+
+
+def set_project_ioctl(path, gid):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        buf = bytearray(struct.calcsize(FSXATTR_FORMAT))
+        fcntl.ioctl(fd, FS_IOC_FSGETXATTR, buf)
+        xflags, extsize, nextents, projid, cowextsize, pad = struct.unpack(FSXATTR_FORMAT, buf)
+        buf = struct.pack(FSXATTR_FORMAT, xflags | FS_XFLAG_PROJINHERIT, extsize, nextents, gid, cowextsize, pad)
+        fcntl.ioctl(fd, FS_IOC_FSSETXATTR, buf)
+    finally:
+        os.close(fd)
 
 
 def set_project(path, gid):
+    # the directory is freshly created and empty, so setting it alone is enough
+    try:
+        debug(f'Setting project {gid} on {path} with ioctl')
+        set_project_ioctl(path, gid)
+        return
+    except OSError as e:
+        debug(f'Unable to set project with ioctl: {e}')
     cmd = [LFS_PATH, 'project', '-p', str(gid), '-s', '-r', path]
-    execute(cmd)
+    execute_async(cmd)
 
 
-def synchronize_storage(group_grants):
-    system_groups_raw = grp.getgrall()
-    system_groups_gid = {}
-    for sgr in system_groups_raw:
-        system_groups_gid[sgr.gr_name] = sgr.gr_gid
-
-    for group, grants in group_grants.items():
-        if group not in system_groups_gid.keys():
-            debug(f'Group: {group} not present in the system!')
-            continue
-        capacity = sum_storage(grants)
-        if capacity < 1:
-            capacity = 1
-        gid = system_groups_gid[group]
-        debug(f'group: {group}, capacity: {capacity}, gid: {gid}')
-
-        group_dir_path = PROJECT_BASE + group
-        if os.path.isdir(group_dir_path):
-            quota = check_quota(gid)
-            if quota != capacity:
-                set_quota(gid, capacity)
-        else:
-            os.mkdir(group_dir_path)
-            os.chmod(group_dir_path, stat.S_ISGID
-                     | stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR
-                     | stat.S_IRGRP | stat.S_IWGRP | stat.S_IXGRP)
+def synchronize_group(group, grants, gid, quotas):
+    capacity = sum_storage(grants)
+    if capacity < 1:
+        capacity = 1
+    debug(f'group: {group}, capacity: {capacity}, gid: {gid}')
+
+    group_dir_path = os.path.join(PROJECT_BASE, group)
+    created = False
+    try:
+        # the only metadata call for an existing directory, its mode and group are left as they are
+        os.stat(group_dir_path)
+    except FileNotFoundError:
+        try:
+            os.mkdir(group_dir_path, MODE)
+            created = True
+        except FileExistsError:
+            debug(f'Directory {group_dir_path} already created')
+        st = os.stat(group_dir_path)
+        if stat.S_IMODE(st.st_mode) != MODE:
+            os.chmod(group_dir_path, MODE)
+        if st.st_gid != gid:
             os.chown(group_dir_path, -1, gid)
-            set_project(group_dir_path, gid)
+
+    if created:
+        set_project(group_dir_path, gid)
+        # the project id may already carry a limit, e.g. when the directory was recreated
+        if quotas is None or quotas.get(gid) != capacity:
+            set_quota(gid, capacity)
+    else:
+        if quotas is not None and gid in quotas:
+            quota = quotas[gid]
+        else:
+            quota = check_quota(gid)
+        if quota != capacity:
             set_quota(gid, capacity)
 
 
+def synchronize_storage(group_grants):
+    quotas = get_all_quotas()
+
+    failed = False
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        futures = {}
+        for group, grants in group_grants.items():
+            try:
+                gid = grp.getgrnam(group).gr_gid
+            except KeyError:
+                debug(f'Group: {group} not present in the system!')
+                continue
+            futures[executor.submit(synchronize_group, group, grants, gid, quotas)] = group
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Unable to synchronize group {futures[future]}: {e}')
+                failed = True
+    if not wait_commands():
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
 def is_grant_active(grant):
     # end = datetime.grant['end'] + datetime.timedelta(days=1)
     # start = datetime.grant['start']
     # if end > datetime.datetime.now().date() and start < datetime.datetime.now().date() and 'grant_active' in grant['state']:
-    if 'accepted' in grant['status'] or 'active' in grant['status']:
-        return True
-    else:
-        return False
+    return grant['status'] in ACTIVE_STATES
 
 
 def main():
@@ -174,18 +450,27 @@ def main():
         global verbose
         verbose = True
 
-    data = get_data()
-    group_grants = {}
-    for group in data['groups']:
-        group_grants[group['name']] = []
-    for grant in data['grants']:
-        if not is_grant_active(grant):
-            continue
-        group_name = grant['group']
-        if group_name in group_grants.keys():
-            group_grants[group_name] += [grant]
-        else:
-            debug(f"No group {group_name} for grant: {grant['name']}")
+    global PROJECT_BASE, PROJECT_FS, STORAGE_RESOURCE, QUOTA_RE
+    PROJECT_BASE = args['--project-base']
+    PROJECT_FS = args['--project-fs']
+    QUOTA_RE = quota_pattern(PROJECT_FS)
+    STORAGE_RESOURCE = args['--resource']
+
+    groups = []
+    grants_by_group = defaultdict(list)
+    # inactive grants are dropped as soon as they are parsed
+    for key, item in get_data():
+        if key == 'groups':
+            groups.append(item['name'])
+        elif is_grant_active(item):
+            grants_by_group[item['group']].append(item)
+
+    # groups without active grants are still synchronized, to the minimal capacity
+    group_grants = {group: grants_by_group.get(group, []) for group in groups}
+    for group_name, grants in grants_by_group.items():
+        if group_name not in group_grants:
+            for grant in grants:
+                debug(f"No group {group_name} for grant: {grant['name']}")
 
     synchronize_storage(group_grants)
 